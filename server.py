@@ -4,180 +4,520 @@ WebRTC Signaling Server
 """
 
 from aiohttp import web
-import json
+import asyncio
 import logging
-from datetime import datetime
+import orjson
+import os
+import re
 
+# Формат без %(asctime)s — время не форматируется на каждую запись
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+def _dumps(obj):
+    """Сериализация через orjson (быстрее stdlib json на мелких dict)"""
+    return orjson.dumps(obj).decode()
+
+
+# Грамматика JSON-числа (для среза значений без полного разбора)
+_NUMBER_RE = re.compile(r'-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?')
+
+
+def _json_value_slice(raw, key):
+    """Вырезает JSON-значение ключа key из сырого сообщения без полного разбора.
+
+    Возвращает срез строки raw или None, если значение найти не удалось.
+    """
+    needle = f'"{key}":'
+    i = raw.find(needle)
+    if i == -1:
+        return None
+    i += len(needle)
+    n = len(raw)
+    while i < n and raw[i] in ' \t\r\n':
+        i += 1
+    if i >= n:
+        return None
+    start = i
+    ch = raw[i]
+    if ch in '{[':
+        # Объект или массив: сканируем до парной скобки с учётом строк
+        depth = 0
+        in_str = False
+        esc = False
+        while i < n:
+            c = raw[i]
+            if in_str:
+                if esc:
+                    esc = False
+                elif c == '\\':
+                    esc = True
+                elif c == '"':
+                    in_str = False
+            elif c == '"':
+                in_str = True
+            elif c in '{[':
+                depth += 1
+            elif c in '}]':
+                depth -= 1
+                if depth == 0:
+                    return raw[start:i + 1]
+            i += 1
+        return None
+    if ch == '"':
+        # Строка: сканируем до закрывающей кавычки с учётом экранирования
+        i += 1
+        esc = False
+        while i < n:
+            c = raw[i]
+            if esc:
+                esc = False
+            elif c == '\\':
+                esc = True
+            elif c == '"':
+                return raw[start:i + 1]
+            i += 1
+        return None
+    # Число / true / false / null: срез отдаём только если он проходит
+    # грамматику литерала, иначе пусть кадр разбирает orjson
+    while i < n and raw[i] not in ',}]':
+        i += 1
+    value = raw[start:i].strip()
+    if value in ('true', 'false', 'null') or _NUMBER_RE.fullmatch(value):
+        return value
+    return None
+
+
+def _scan_str(raw, key):
+    """Извлекает строковое значение ключа из сырого кадра без разбора JSON.
+
+    Возвращает None для отсутствующих, не-строковых или экранированных
+    значений — тогда вызывающий код разбирает кадр целиком.
+    """
+    value = _json_value_slice(raw, key)
+    if value is None or len(value) < 2 or value[0] != '"' or '\\' in value:
+        return None
+    return value[1:-1]
+
+
+def _scan_target(raw):
+    """Имя получателя из сырого кадра; при неудаче — полный разбор"""
+    target = _scan_str(raw, 'target')
+    if target is None:
+        target = orjson.loads(raw).get('target')
+    return target
+
+
+def _enqueue(queue, frame):
+    """Кладёт кадр в очередь получателя; при переполнении вытесняет старейший"""
+    try:
+        queue.put_nowait(frame)
+    except asyncio.QueueFull:
+        try:
+            queue.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+        queue.put_nowait(frame)
+
+
+def _relay(target_queue, msg_type, username, key, raw):
+    """Пересылает сигнальное сообщение, переиспользуя срез исходного JSON.
+
+    Исходящий кадр собирается склейкой, без повторной сериализации
+    вложенного payload (SDP/candidate); orjson используется только если
+    вырезать значение из сырого сообщения не удалось.
+    """
+    payload = _json_value_slice(raw, key)
+    if payload is None:
+        payload = _dumps(orjson.loads(raw).get(key))
+    _enqueue(
+        target_queue,
+        f'{{"type":"{msg_type}","from":{_dumps(username)},"{key}":{payload}}}'
+    )
+
+
+async def _writer_loop(ws, queue):
+    """Задача-писатель одного клиента: разгружает его очередь в сокет.
+
+    Отправители не ждут TCP-дренажа получателя — медленный клиент
+    тормозит только свою очередь, а не чужие обработчики. Проснувшись,
+    писатель выгребает всё накопившееся и склеивает пачку в один
+    NDJSON-кадр (сообщения через '\n') — одна запись в сокет на burst;
+    клиент разбирает кадр построчно. Одиночное сообщение уходит как
+    обычный JSON-кадр.
+    """
+    get = queue.get
+    get_nowait = queue.get_nowait
+    empty = queue.empty
+    send_str = ws.send_str
+    try:
+        while True:
+            frame = await get()
+            if not empty():
+                batch = [frame]
+                while True:
+                    try:
+                        batch.append(get_nowait())
+                    except asyncio.QueueEmpty:
+                        break
+                frame = '\n'.join(batch)
+            await send_str(frame)
+    except ConnectionResetError:
+        pass
+
+
+# Размер очереди исходящих сообщений одного клиента
+QUEUE_MAXSIZE = 256
+
+# Максимальный размер сигнального сообщения (SDP помещается с запасом)
+MAX_MSG_SIZE = 65536
+
+# Интервал ping/pong, сек: мёртвые соединения закрываются самим aiohttp
+HEARTBEAT = 30.0
+
+# Статические кадры ошибок (сериализованы один раз при старте)
+ERR_USERNAME_TAKEN = '{"type":"error","message":"Username already taken"}'
+
+# CORS-заголовки (собраны один раз, а не на каждый запрос)
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Headers': '*',
+}
+
+
+class Conn:
+    """Состояние одного подключённого клиента.
+
+    __slots__ убирает per-instance dict; peer кэширует собеседника,
+    чтобы не ходить в словарь users на каждый пересылаемый кадр.
+    """
+    __slots__ = ('ws', 'username', 'queue', 'writer', 'peer')
+
+    def __init__(self, ws, username, queue, writer):
+        self.ws = ws
+        self.username = username
+        self.queue = queue
+        self.writer = writer
+        self.peer = None  # Conn собеседника текущего звонка
+
+
 # Хранилище активных пользователей
-users = {}  # {username: websocket}
+users = {}  # {username: Conn}
+
+# Счётчики подключений/отключений с последней сводки (_stats_loop)
+_conn_events = 0
+_disc_events = 0
+
+
+async def _stats_loop():
+    """Раз в секунду сводит подключения/отключения в одну строку лога.
+
+    Одна запись на интервал вместо logger.info на каждый connect и
+    disconnect — под штормом реконнектов это убирает захват блокировки
+    хендлера логов и запись в stdout на каждое событие.
+    """
+    global _conn_events, _disc_events
+    while True:
+        await asyncio.sleep(1)
+        if _conn_events or _disc_events:
+            logger.info("Connects: %d/s, disconnects: %d/s, total users: %d",
+                        _conn_events, _disc_events, len(users))
+            _conn_events = 0
+            _disc_events = 0
+
+
+def _resolve(conn, target):
+    """Conn получателя по имени; закэшированный peer сверяется с реестром.
+
+    Односторонняя ссылка может пережить отключение или перерегистрацию
+    собеседника (_unpair чистит только взаимные пары), поэтому кэш
+    валиден только пока в users лежит тот же самый объект — иначе кадры
+    ушли бы в очередь отменённого писателя.
+    """
+    if conn is not None:
+        peer = conn.peer
+        if peer is not None and peer.username == target:
+            if users.get(target) is peer:
+                return peer
+            conn.peer = None  # протухшая ссылка — сбрасываем
+    return users.get(target)
+
+
+async def _handle_login(ws, conn, raw):
+    """Регистрация пользователя"""
+    global _conn_events
+    data = orjson.loads(raw)
+    name = data.get('username')
+    queue = asyncio.Queue(maxsize=QUEUE_MAXSIZE)
+    new_conn = Conn(ws, name, queue, None)
+
+    # setdefault: проверка занятости и вставка за один проход по словарю
+    if users.setdefault(name, new_conn) is not new_conn:
+        await ws.send_str(ERR_USERNAME_TAKEN)
+        await ws.close()
+        return conn
+
+    conn = new_conn
+    conn.writer = asyncio.create_task(_writer_loop(ws, queue))
+    try:
+        await ws.send_json({
+            'type': 'login_success',
+            'username': name
+        }, dumps=_dumps)
+    except BaseException:
+        # Клиент оборвал соединение во время ответа: откатываем
+        # регистрацию сами, иначе имя останется занятым навсегда —
+        # вызывающий цикл ещё не видит conn и не приберёт за нами
+        users.pop(name, None)
+        conn.writer.cancel()
+        raise
+    _conn_events += 1
+    logger.debug("User %s connected. Total users: %d", name, len(users))
+    return conn
+
+
+def _username(conn):
+    """Имя отправителя (None до регистрации)"""
+    return conn.username if conn is not None else None
+
+
+def _pair(conn, target_conn):
+    """Кэширует собеседников друг у друга на время звонка"""
+    if conn is not None:
+        conn.peer = target_conn
+        target_conn.peer = conn
+
+
+def _unpair(conn):
+    """Сбрасывает кэш собеседника с обеих сторон"""
+    if conn is not None and conn.peer is not None:
+        if conn.peer.peer is conn:
+            conn.peer.peer = None
+        conn.peer = None
+
+
+async def _handle_call(ws, conn, raw):
+    """Инициация звонка"""
+    target = _scan_target(raw)
+    target_conn = _resolve(conn, target)
+
+    if target_conn is None:
+        await ws.send_str(
+            f'{{"type":"error","message":{_dumps(f"User {target} not found")}}}'
+        )
+    else:
+        _pair(conn, target_conn)
+        _relay(target_conn.queue, 'incoming_call', _username(conn), 'callType', raw)
+        logger.info("Call from %s to %s (%s)", _username(conn), target, _scan_str(raw, 'callType'))
+    return conn
+
+
+async def _handle_offer(ws, conn, raw):
+    """WebRTC сигнализация - Offer"""
+    target = _scan_target(raw)
+    target_conn = _resolve(conn, target)
+
+    if target_conn is not None:
+        _pair(conn, target_conn)
+        _relay(target_conn.queue, 'offer', _username(conn), 'offer', raw)
+        logger.info("Offer from %s to %s", _username(conn), target)
+    return conn
+
+
+async def _handle_answer(ws, conn, raw):
+    """WebRTC сигнализация - Answer"""
+    target = _scan_target(raw)
+    target_conn = _resolve(conn, target)
+
+    if target_conn is not None:
+        _relay(target_conn.queue, 'answer', _username(conn), 'answer', raw)
+        logger.info("Answer from %s to %s", _username(conn), target)
+    return conn
+
+
+async def _handle_ice_candidate(ws, conn, raw):
+    """WebRTC сигнализация - ICE Candidate"""
+    target = _scan_target(raw)
+    target_conn = _resolve(conn, target)
+
+    if target_conn is not None:
+        _relay(target_conn.queue, 'ice-candidate', _username(conn), 'candidate', raw)
+    return conn
+
+
+async def _handle_decline(ws, conn, raw):
+    """Отклонение звонка"""
+    target = _scan_target(raw)
+    target_conn = _resolve(conn, target)
+
+    if target_conn is not None:
+        _enqueue(
+            target_conn.queue,
+            f'{{"type":"call_declined","from":{_dumps(_username(conn))}}}'
+        )
+        _unpair(conn)
+        logger.info("Call declined by %s", _username(conn))
+    return conn
+
+
+async def _handle_end_call(ws, conn, raw):
+    """Завершение звонка"""
+    target = _scan_target(raw)
+    target_conn = _resolve(conn, target)
+
+    if target_conn is not None:
+        _enqueue(
+            target_conn.queue,
+            f'{{"type":"call_ended","from":{_dumps(_username(conn))}}}'
+        )
+        _unpair(conn)
+        logger.info("Call ended by %s", _username(conn))
+    return conn
+
+
+# Таблица диспетчеризации по типу сообщения
+HANDLERS = {
+    'login': _handle_login,
+    'call': _handle_call,
+    'offer': _handle_offer,
+    'answer': _handle_answer,
+    'ice-candidate': _handle_ice_candidate,
+    'decline': _handle_decline,
+    'end_call': _handle_end_call,
+}
 
 
 async def websocket_handler(request):
     """Обработчик WebSocket соединений"""
-    ws = web.WebSocketResponse()
+    ws = web.WebSocketResponse(
+        heartbeat=HEARTBEAT,
+        receive_timeout=HEARTBEAT * 2,
+        max_msg_size=MAX_MSG_SIZE,
+        compress=False,  # permessage-deflate невыгоден на мелких кадрах
+    )
     await ws.prepare(request)
-    
-    username = None
-    
+
+    conn = None
+
+    # Горячие имена в локальных переменных: убирает повторные глобальные
+    # и атрибутные lookups на каждое сообщение (LOAD_FAST вместо
+    # LOAD_GLOBAL/LOAD_ATTR в цикле)
+    get_handler = HANDLERS.get
+    scan_str = _scan_str
+    text_type = web.WSMsgType.TEXT
+    error_type = web.WSMsgType.ERROR
+
     try:
         async for msg in ws:
-            if msg.type == web.WSMsgType.TEXT:
+            if msg.type == text_type:
+                raw = msg.data
+
+                # O(1) префильтр: мусор отбрасываем до любого разбора
+                if not raw or raw[0] != '{' or raw[-1] != '}':
+                    logger.error("Invalid JSON received")
+                    continue
+
+                # Тип определяем сканом сырого кадра до разбора JSON;
+                # неизвестный тип — признак чужого протокола, закрываем
+                handler = get_handler(scan_str(raw, 'type'))
+                if handler is None:
+                    logger.error("Unknown message type, closing connection")
+                    await ws.close()
+                    break
+
                 try:
-                    data = json.loads(msg.data)
-                    message_type = data.get('type')
-                    
-                    # Регистрация пользователя
-                    if message_type == 'login':
-                        username = data.get('username')
-                        if username in users:
-                            await ws.send_json({
-                                'type': 'error',
-                                'message': 'Username already taken'
-                            })
-                            await ws.close()
-                            return
-                        
-                        users[username] = ws
-                        await ws.send_json({
-                            'type': 'login_success',
-                            'username': username
-                        })
-                        logger.info(f"User {username} connected. Total users: {len(users)}")
-                    
-                    # Инициация звонка
-                    elif message_type == 'call':
-                        target = data.get('target')
-                        call_type = data.get('callType')
-                        
-                        if target not in users:
-                            await ws.send_json({
-                                'type': 'error',
-                                'message': f'User {target} not found'
-                            })
-                        else:
-                            target_ws = users[target]
-                            await target_ws.send_json({
-                                'type': 'incoming_call',
-                                'from': username,
-                                'callType': call_type
-                            })
-                            logger.info(f"Call from {username} to {target} ({call_type})")
-                    
-                    # WebRTC сигнализация - Offer
-                    elif message_type == 'offer':
-                        target = data.get('target')
-                        offer = data.get('offer')
-                        
-                        if target in users:
-                            target_ws = users[target]
-                            await target_ws.send_json({
-                                'type': 'offer',
-                                'from': username,
-                                'offer': offer
-                            })
-                            logger.info(f"Offer from {username} to {target}")
-                    
-                    # WebRTC сигнализация - Answer
-                    elif message_type == 'answer':
-                        target = data.get('target')
-                        answer = data.get('answer')
-                        
-                        if target in users:
-                            target_ws = users[target]
-                            await target_ws.send_json({
-                                'type': 'answer',
-                                'from': username,
-                                'answer': answer
-                            })
-                            logger.info(f"Answer from {username} to {target}")
-                    
-                    # WebRTC сигнализация - ICE Candidate
-                    elif message_type == 'ice-candidate':
-                        target = data.get('target')
-                        candidate = data.get('candidate')
-                        
-                        if target in users:
-                            target_ws = users[target]
-                            await target_ws.send_json({
-                                'type': 'ice-candidate',
-                                'from': username,
-                                'candidate': candidate
-                            })
-                    
-                    # Отклонение звонка
-                    elif message_type == 'decline':
-                        target = data.get('target')
-                        
-                        if target in users:
-                            target_ws = users[target]
-                            await target_ws.send_json({
-                                'type': 'call_declined',
-                                'from': username
-                            })
-                            logger.info(f"Call declined by {username}")
-                    
-                    # Завершение звонка
-                    elif message_type == 'end_call':
-                        target = data.get('target')
-                        
-                        if target in users:
-                            target_ws = users[target]
-                            await target_ws.send_json({
-                                'type': 'call_ended',
-                                'from': username
-                            })
-                            logger.info(f"Call ended by {username}")
-                
-                except json.JSONDecodeError:
+                    conn = await handler(ws, conn, raw)
+                except orjson.JSONDecodeError:
                     logger.error("Invalid JSON received")
-                except Exception as e:
-                    logger.error(f"Error processing message: {e}")
-            
-            elif msg.type == web.WSMsgType.ERROR:
-                logger.error(f'WebSocket error: {ws.exception()}')
-    
+                except (KeyError, TypeError) as e:
+                    # Корректный JSON с неожиданными типами значений
+                    # (например, target-объект вместо строки)
+                    logger.error("Malformed message: %s", e)
+
+            elif msg.type == error_type:
+                logger.error('WebSocket error: %s', ws.exception())
+
     finally:
         # Удаление пользователя при отключении
-        if username and username in users:
-            del users[username]
-            logger.info(f"User {username} disconnected. Total users: {len(users)}")
-    
+        if conn is not None:
+            _unpair(conn)
+            conn.writer.cancel()
+            if users.pop(conn.username, None) is not None:
+                global _disc_events
+                _disc_events += 1
+                logger.debug("User %s disconnected. Total users: %d", conn.username, len(users))
+
     return ws
 
 
+# Кэш содержимого index.html (читается один раз при первом запросе)
+_index_html = None
+
+
 async def index_handler(request):
     """Возвращает HTML страницу"""
-    with open('index.html', 'r', encoding='utf-8') as f:
-        return web.Response(text=f.read(), content_type='text/html')
+    global _index_html
+    if _index_html is None:
+        with open('index.html', 'r', encoding='utf-8') as f:
+            _index_html = f.read()
+    return web.Response(text=_index_html, content_type='text/html')
 
 
-def main():
-    """Запуск сервера"""
+def create_app():
+    """Создание и настройка приложения"""
     app = web.Application()
-    
+
     # Роуты
     app.router.add_get('/', index_handler)
     app.router.add_get('/ws', websocket_handler)
-    
-    # CORS для разработки
-    async def cors_middleware(app, handler):
-        async def middleware_handler(request):
-            response = await handler(request)
-            response.headers['Access-Control-Allow-Origin'] = '*'
-            response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
-            response.headers['Access-Control-Allow-Headers'] = '*'
-            return response
-        return middleware_handler
-    
-    app.middlewares.append(cors_middleware)
-    
-    # Запуск
+
+    # CORS для разработки: статические заголовки через on_response_prepare,
+    # без middleware-обёртки вокруг каждого обработчика
+    async def on_prepare(request, response):
+        response.headers.update(CORS_HEADERS)
+
+    app.on_response_prepare.append(on_prepare)
+
+    # Периодическая сводка подключений вместо лога на каждое событие
+    async def start_stats(app):
+        app['stats_task'] = asyncio.create_task(_stats_loop())
+
+    async def stop_stats(app):
+        app['stats_task'].cancel()
+
+    app.on_startup.append(start_stats)
+    app.on_cleanup.append(stop_stats)
+    return app
+
+
+def _serve(reuse_port=False):
+    """Запуск одного процесса-воркера"""
+    # uvloop: C-реализация event loop, заметно быстрее на мелких сообщениях
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        logger.warning("uvloop not available, using default event loop")
+
     logger.info("Starting WebRTC Signaling Server on http://localhost:8000")
-    web.run_app(app, host='0.0.0.0', port=8000)
+    web.run_app(create_app(), host='0.0.0.0', port=8000, reuse_port=reuse_port)
+
+
+def main():
+    """Запуск сервера"""
+    # Словарь users процесс-локален: без внешнего брокера собеседники на
+    # разных воркерах не видят друг друга, так что много-процессный режим
+    # закрыт, пока не появится кросс-процессный роутинг
+    workers = int(os.environ.get('WORKERS', '1'))
+    if workers > 1:
+        raise SystemExit(
+            "WORKERS>1 is not supported: the users map is per-process and "
+            "peers on different workers cannot reach each other"
+        )
+    _serve()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
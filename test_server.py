@@ -25,6 +25,14 @@ class TestWebRTCServer(AioHTTPTestCase):
         """Очистка перед каждым тестом"""
         await super().setUp()
         users.clear()
+
+    async def _login(self, ws, username):
+        """Регистрация клиента и ожидание подтверждения"""
+        await ws.send_json({
+            'type': 'login',
+            'username': username
+        })
+        return await ws.receive_json()
     
     @unittest_run_loop
     async def test_index_page(self):
@@ -84,19 +92,13 @@ class TestWebRTCServer(AioHTTPTestCase):
         """Тест инициации звонка"""
         # Создаем двух пользователей
         async with self.client.ws_connect('/ws') as ws_caller:
-            await ws_caller.send_json({
-                'type': 'login',
-                'username': 'caller'
-            })
-            await ws_caller.receive_json()
-            
             async with self.client.ws_connect('/ws') as ws_callee:
-                await ws_callee.send_json({
-                    'type': 'login',
-                    'username': 'callee'
-                })
-                await ws_callee.receive_json()
-                
+                # Параллельная регистрация обоих клиентов
+                await asyncio.gather(
+                    self._login(ws_caller, 'caller'),
+                    self._login(ws_callee, 'callee')
+                )
+
                 # Инициация звонка
                 await ws_caller.send_json({
                     'type': 'call',
@@ -134,19 +136,13 @@ class TestWebRTCServer(AioHTTPTestCase):
     async def test_offer_exchange(self):
         """Тест обмена WebRTC offer"""
         async with self.client.ws_connect('/ws') as ws_caller:
-            await ws_caller.send_json({
-                'type': 'login',
-                'username': 'caller'
-            })
-            await ws_caller.receive_json()
-            
             async with self.client.ws_connect('/ws') as ws_callee:
-                await ws_callee.send_json({
-                    'type': 'login',
-                    'username': 'callee'
-                })
-                await ws_callee.receive_json()
-                
+                # Параллельная регистрация обоих клиентов
+                await asyncio.gather(
+                    self._login(ws_caller, 'caller'),
+                    self._login(ws_callee, 'callee')
+                )
+
                 # Отправка offer
                 test_offer = {
                     'type': 'offer',
@@ -169,19 +165,13 @@ class TestWebRTCServer(AioHTTPTestCase):
     async def test_answer_exchange(self):
         """Тест обмена WebRTC answer"""
         async with self.client.ws_connect('/ws') as ws_caller:
-            await ws_caller.send_json({
-                'type': 'login',
-                'username': 'caller'
-            })
-            await ws_caller.receive_json()
-            
             async with self.client.ws_connect('/ws') as ws_callee:
-                await ws_callee.send_json({
-                    'type': 'login',
-                    'username': 'callee'
-                })
-                await ws_callee.receive_json()
-                
+                # Параллельная регистрация обоих клиентов
+                await asyncio.gather(
+                    self._login(ws_caller, 'caller'),
+                    self._login(ws_callee, 'callee')
+                )
+
                 # Отправка answer
                 test_answer = {
                     'type': 'answer',
@@ -204,19 +194,13 @@ class TestWebRTCServer(AioHTTPTestCase):
     async def test_ice_candidate_exchange(self):
         """Тест обмена ICE candidates"""
         async with self.client.ws_connect('/ws') as ws1:
-            await ws1.send_json({
-                'type': 'login',
-                'username': 'user1'
-            })
-            await ws1.receive_json()
-            
             async with self.client.ws_connect('/ws') as ws2:
-                await ws2.send_json({
-                    'type': 'login',
-                    'username': 'user2'
-                })
-                await ws2.receive_json()
-                
+                # Параллельная регистрация обоих клиентов
+                await asyncio.gather(
+                    self._login(ws1, 'user1'),
+                    self._login(ws2, 'user2')
+                )
+
                 # Отправка ICE candidate
                 test_candidate = {
                     'candidate': 'candidate:1 1 UDP 2130706431 192.168.1.1 54321 typ host',
@@ -240,19 +224,13 @@ class TestWebRTCServer(AioHTTPTestCase):
     async def test_call_decline(self):
         """Тест отклонения звонка"""
         async with self.client.ws_connect('/ws') as ws_caller:
-            await ws_caller.send_json({
-                'type': 'login',
-                'username': 'caller'
-            })
-            await ws_caller.receive_json()
-            
             async with self.client.ws_connect('/ws') as ws_callee:
-                await ws_callee.send_json({
-                    'type': 'login',
-                    'username': 'callee'
-                })
-                await ws_callee.receive_json()
-                
+                # Параллельная регистрация обоих клиентов
+                await asyncio.gather(
+                    self._login(ws_caller, 'caller'),
+                    self._login(ws_callee, 'callee')
+                )
+
                 # Отклонение звонка
                 await ws_callee.send_json({
                     'type': 'decline',
@@ -268,19 +246,13 @@ class TestWebRTCServer(AioHTTPTestCase):
     async def test_call_end(self):
         """Тест завершения звонка"""
         async with self.client.ws_connect('/ws') as ws1:
-            await ws1.send_json({
-                'type': 'login',
-                'username': 'user1'
-            })
-            await ws1.receive_json()
-            
             async with self.client.ws_connect('/ws') as ws2:
-                await ws2.send_json({
-                    'type': 'login',
-                    'username': 'user2'
-                })
-                await ws2.receive_json()
-                
+                # Параллельная регистрация обоих клиентов
+                await asyncio.gather(
+                    self._login(ws1, 'user1'),
+                    self._login(ws2, 'user2')
+                )
+
                 # Завершение звонка
                 await ws1.send_json({
                     'type': 'end_call',
@@ -313,17 +285,18 @@ class TestWebRTCServer(AioHTTPTestCase):
         """Тест работы с несколькими пользователями"""
         connections = []
         usernames = ['user1', 'user2', 'user3']
-        
+
+        async def connect_and_login(username):
+            ws = await self.client.ws_connect('/ws')
+            connections.append(ws)
+            await self._login(ws, username)
+
         try:
-            for username in usernames:
-                ws = await self.client.ws_connect('/ws')
-                await ws.send_json({
-                    'type': 'login',
-                    'username': username
-                })
-                await ws.receive_json()
-                connections.append(ws)
-            
+            # Параллельное подключение и регистрация всех клиентов
+            await asyncio.gather(*(
+                connect_and_login(username) for username in usernames
+            ))
+
             # Проверка, что все пользователи зарегистрированы
             assert len(users) == 3
             for username in usernames:
@@ -333,6 +306,24 @@ class TestWebRTCServer(AioHTTPTestCase):
             for ws in connections:
                 await ws.close()
     
+    @unittest_run_loop
+    async def test_unknown_message_type(self):
+        """Тест закрытия соединения при неизвестном типе сообщения"""
+        async with self.client.ws_connect('/ws') as ws:
+            # Мусор, отброшенный префильтром, соединение не закрывает
+            await ws.send_str('invalid json data')
+            await ws.send_json({
+                'type': 'login',
+                'username': 'prefilter_user'
+            })
+            msg = await ws.receive_json()
+            assert msg['type'] == 'login_success'
+
+            # А неизвестный тип сообщения — закрывает
+            await ws.send_json({'type': 'bogus'})
+            msg = await ws.receive()
+            assert msg.type == web.WSMsgType.CLOSE
+
     @unittest_run_loop
     async def test_invalid_json(self):
         """Тест обработки невалидного JSON"""
@@ -350,21 +341,13 @@ class TestWebRTCServer(AioHTTPTestCase):
     async def test_full_call_flow(self):
         """Тест полного потока звонка: инициация -> offer -> answer -> ICE -> завершение"""
         async with self.client.ws_connect('/ws') as ws_caller:
-            # Регистрация caller
-            await ws_caller.send_json({
-                'type': 'login',
-                'username': 'caller'
-            })
-            await ws_caller.receive_json()
-            
             async with self.client.ws_connect('/ws') as ws_callee:
-                # Регистрация callee
-                await ws_callee.send_json({
-                    'type': 'login',
-                    'username': 'callee'
-                })
-                await ws_callee.receive_json()
-                
+                # Параллельная регистрация caller и callee
+                await asyncio.gather(
+                    self._login(ws_caller, 'caller'),
+                    self._login(ws_callee, 'callee')
+                )
+
                 # 1. Инициация звонка
                 await ws_caller.send_json({
                     'type': 'call',